@@ -1,6 +1,6 @@
 import streamlit as st
 import google.generativeai as genai
-from PIL import Image, ExifTags
+from PIL import Image, ImageOps, ExifTags
 import time
 from datetime import datetime
 import warnings
@@ -13,6 +13,10 @@ import sys
 import json
 import re
 import hashlib
+import struct
+import asyncio
+import threading
+import concurrent.futures
 
 # ================= 0. 核心配置 =================
 warnings.filterwarnings("ignore")
@@ -40,6 +44,27 @@ GUEST_FILE = "guest_usage_v2.json"
 MAX_TOTAL_USAGE = 3
 MAX_PRO_USAGE = 1
 
+# RAW 只取内嵌预览，HEIC 依赖 pillow-heif（未安装时自动隐藏）
+RAW_TYPES = ["dng", "cr2", "cr3", "nef", "arw"]
+HEIF_TYPES = ["heic", "heif"]
+# RAW 内嵌预览解码后的长边上限（像素，DCT 缩放档位允许略超）
+RAW_PREVIEW_EDGE = 2048
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_SUPPORTED = True
+except ImportError:
+    HEIF_SUPPORTED = False
+
+# 模型与时限：整条评估链路（含兜底）必须在时限内交付
+DAILY_MODEL = "gemini-2.0-flash-lite-preview-02-05"
+PRO_MODEL = "gemini-2.5-flash"
+MODE_DEADLINES = {'daily': 30, 'pro': 60}
+# 专业模式剩余不足该秒数时放弃 PRO_MODEL，改用 DAILY_MODEL 兜底
+PRO_FALLBACK_RESERVE = 15
+# 报告缓存有效期（秒）
+AI_CACHE_TTL = 3600
+
 # ================= 1. CSS 深度美化 =================
 st.markdown("""
     <style>
@@ -163,23 +188,29 @@ def get_guest_stats(phone):
             return data.get(phone, {"total": 0, "pro": 0})
     except: return {"total": 0, "pro": 0}
 
-def update_guest_usage(phone, mode_type):
-    data = {}
-    if os.path.exists(GUEST_FILE):
-        try:
-            with open(GUEST_FILE, 'r') as f:
-                data = json.load(f)
-        except: pass
-    
-    user_stats = data.get(phone, {"total": 0, "pro": 0})
-    user_stats["total"] += 1
-    if mode_type == 'pro':
-        user_stats["pro"] += 1
+@st.cache_resource
+def get_guest_lock():
+    """游客次数文件的进程级锁：多个标签页同时评估时，校验 + 预扣必须一起完成。"""
+    return threading.RLock()
+
+def update_guest_usage(phone, mode_type, delta=1):
+    with get_guest_lock():
+        data = {}
+        if os.path.exists(GUEST_FILE):
+            try:
+                with open(GUEST_FILE, 'r') as f:
+                    data = json.load(f)
+            except: pass
         
-    data[phone] = user_stats
-    with open(GUEST_FILE, 'w') as f:
-        json.dump(data, f)
-    return user_stats
+        user_stats = data.get(phone, {"total": 0, "pro": 0})
+        user_stats["total"] = max(0, user_stats["total"] + delta)
+        if mode_type == 'pro':
+            user_stats["pro"] = max(0, user_stats["pro"] + delta)
+            
+        data[phone] = user_stats
+        with open(GUEST_FILE, 'w') as f:
+            json.dump(data, f)
+        return user_stats
 
 def check_guest_permission(phone, mode_type):
     stats = get_guest_stats(phone)
@@ -190,13 +221,19 @@ def check_guest_permission(phone, mode_type):
         return False, "❌ 专业模式试用仅限 1 次，您已用完！请切换回日常模式，或升级会员。"
     return True, "OK"
 
-def get_image_hash(image):
-    try:
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG')
-        return hashlib.md5(img_byte_arr.getvalue()).hexdigest()
-    except:
-        return str(time.time())
+def reserve_guest_usage(phone, mode_type):
+    """校验并预扣一次；报告未交付时调用 update_guest_usage(phone, mode_type, -1) 退回。"""
+    with get_guest_lock():
+        allowed, msg = check_guest_permission(phone, mode_type)
+        if allowed:
+            update_guest_usage(phone, mode_type)
+        return allowed, msg
+
+def downgrade_guest_usage(phone):
+    """降级报告按日常模式计费：退回专业次数，总次数不变。"""
+    with get_guest_lock():
+        update_guest_usage(phone, 'pro', -1)
+        update_guest_usage(phone, 'daily', 1)
 
 def configure_random_key():
     try:
@@ -222,8 +259,264 @@ def get_exif_data(image):
                 if decoded in ['Make', 'Model', 'ISO', 'FNumber', 'ExposureTime']:
                     exif_data[decoded] = str(value)
     except: pass
+    try:
+        # 非 JPEG 对象（convert 后 / RAW 预览图）走通用接口，连同 Exif 子目录一起读
+        exif = image.getexif()
+        tags = dict(exif)
+        tags.update(exif.get_ifd(0x8769))
+        for tag, value in tags.items():
+            decoded = ExifTags.TAGS.get(tag, tag)
+            if decoded == 'ISOSpeedRatings': decoded = 'ISO'
+            if decoded in ['Make', 'Model', 'ISO', 'FNumber', 'ExposureTime'] and decoded not in exif_data:
+                exif_data[decoded] = str(value)
+    except: pass
     return exif_data
 
+# ================= 2.1 RAW / HEIC 快速导入 =================
+# 不做去马赛克：直接从容器里取相机内嵌的全尺寸 JPEG 预览 + 机身 EXIF
+def _tiff_ifds(buf, endian, offset):
+    """遍历 TIFF IFD 链（含 SubIFDs），返回 [{tag: [int, ...]}]，只解析整数类型。"""
+    ifds, todo, seen = [], [offset], set()
+    sizes = {3: ('H', 2), 4: ('I', 4), 13: ('I', 4)}
+    while todo:
+        off = todo.pop()
+        if off in seen or off <= 0 or off + 2 > len(buf): continue
+        seen.add(off)
+        (count,) = struct.unpack_from(endian + 'H', buf, off)
+        entries = {}
+        for i in range(count):
+            pos = off + 2 + i * 12
+            if pos + 12 > len(buf): break
+            tag, typ, n = struct.unpack_from(endian + 'HHI', buf, pos)
+            if typ not in sizes or n == 0 or n > 64: continue
+            fmt, size = sizes[typ]
+            data_off = pos + 8 if n * size <= 4 else struct.unpack_from(endian + 'I', buf, pos + 8)[0]
+            if data_off + n * size > len(buf): continue
+            entries[tag] = list(struct.unpack_from(endian + fmt * n, buf, data_off))
+        ifds.append(entries)
+        todo.extend(entries.get(0x014A, []))  # SubIFDs
+        nxt = off + 2 + count * 12
+        if nxt + 4 <= len(buf):
+            todo.append(struct.unpack_from(endian + 'I', buf, nxt)[0])
+    return ifds
+
+def _tiff_previews(buf):
+    """DNG / NEF / CR2 / ARW：收集所有内嵌 JPEG 的 (offset, length)。"""
+    endian = '<' if buf[:2] == b'II' else '>'
+    (first,) = struct.unpack_from(endian + 'I', buf, 4)
+    found = []
+    for ifd in _tiff_ifds(buf, endian, first):
+        if 0x0201 in ifd and 0x0202 in ifd:
+            found.append((ifd[0x0201][0], ifd[0x0202][0]))
+        elif ifd.get(0x0103, [0])[0] in (6, 7) and len(ifd.get(0x0111, [])) == 1 and len(ifd.get(0x0117, [])) == 1:
+            found.append((ifd[0x0111][0], ifd[0x0117][0]))
+    return found
+
+def _bmff_boxes(buf, start, end):
+    """ISO BMFF（CR3 / HEIC）盒子迭代器：yield (type, payload_start, box_end)。"""
+    pos = start
+    while pos + 8 <= end:
+        size, typ = struct.unpack_from('>I4s', buf, pos)
+        head = 8
+        if size == 1:
+            (size,) = struct.unpack_from('>Q', buf, pos + 8)
+            head = 16
+        elif size == 0:
+            size = end - pos
+        if size < head or pos + size > end: return
+        yield typ, pos + head, pos + size
+        pos += size
+
+CR3_META_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+CR3_PRVW_UUID = bytes.fromhex('eaf42b5e1c984b88b9fbb7dc406e4d16')
+
+def _cr3_parse(buf):
+    """CR3：返回 (JPEG 候选列表, [CMT1, CMT2] TIFF 块)。"""
+    found, cmts = [], {}
+    for typ, p, e in _bmff_boxes(buf, 0, len(buf)):
+        if typ == b'uuid' and buf[p:p + 16] == CR3_PRVW_UUID:
+            # PRVW 中等尺寸预览：头部字段随机型变化，直接定位 SOI
+            soi = buf.find(b'\xff\xd8', p + 16, e)
+            if soi != -1: found.append((soi, e - soi))
+        if typ != b'moov': continue
+        for ctyp, cp, ce in _bmff_boxes(buf, p, e):
+            if ctyp == b'uuid' and buf[cp:cp + 16] == CR3_META_UUID:
+                for mtyp, mp, me in _bmff_boxes(buf, cp + 16, ce):
+                    if mtyp in (b'CMT1', b'CMT2'): cmts[mtyp] = buf[mp:me]
+            elif ctyp == b'trak':
+                # 第一个轨道的首个 sample 即全尺寸 JPEG
+                stbl = _bmff_find(buf, cp, ce, [b'mdia', b'minf', b'stbl'])
+                if not stbl: continue
+                size = offset = None
+                for styp, sp, se in _bmff_boxes(buf, *stbl):
+                    if styp == b'stsz':
+                        size, n = struct.unpack_from('>II', buf, sp + 4)
+                        if size == 0 and n: (size,) = struct.unpack_from('>I', buf, sp + 12)
+                    elif styp == b'co64':
+                        (offset,) = struct.unpack_from('>Q', buf, sp + 8)
+                    elif styp == b'stco':
+                        (offset,) = struct.unpack_from('>I', buf, sp + 8)
+                if size and offset is not None and buf[offset:offset + 2] == b'\xff\xd8':
+                    found.append((offset, size))
+    return found, [cmts.get(b'CMT1'), cmts.get(b'CMT2')]
+
+def _bmff_find(buf, start, end, path):
+    for name in path:
+        for typ, p, e in _bmff_boxes(buf, start, end):
+            if typ == name:
+                start, end = p, e
+                break
+        else: return None
+    return start, end
+
+def _carry_exif(ifd0, exif_ifd):
+    """只搬运展示需要的机身参数，避免把整个 RAW 的 IFD 塞进图片。"""
+    out = Image.Exif()
+    for tag in (0x010F, 0x0110, 0x0112):  # Make / Model / Orientation
+        if tag in ifd0: out[tag] = ifd0[tag]
+    sub = {tag: exif_ifd[tag] for tag in (0x829A, 0x829D, 0x8827) if tag in exif_ifd}
+    if sub: out[0x8769] = sub
+    return out
+
+def load_raw_image(buf):
+    """从 RAW 容器取最大的可解码内嵌 JPEG，返回带 EXIF 的 RGB 图；失败返回 None。"""
+    try:
+        if buf[:4] in (b'II*\x00', b'MM\x00*'):
+            candidates = _tiff_previews(buf)
+            meta = Image.Exif()
+            meta.load(buf)
+            ifd0, exif_ifd = meta, meta.get_ifd(0x8769)
+        elif buf[4:12] == b'ftypcrx ':
+            candidates, (cmt1, cmt2) = _cr3_parse(buf)
+            ifd0, exif_ifd = Image.Exif(), Image.Exif()
+            if cmt1: ifd0.load(cmt1)
+            if cmt2: exif_ifd.load(cmt2)
+        else:
+            return None
+    except Exception as e:
+        logger.warning(f"RAW parse failed: {e}")
+        return None
+
+    for off, length in sorted(set(candidates), key=lambda c: -c[1]):
+        if buf[off:off + 2] != b'\xff\xd8': continue
+        try:
+            # DNG 的无损 JPEG (SOF3) 原始数据在这里会解码失败，自动跳到下一个候选
+            im = Image.open(io.BytesIO(buf[off:off + length]))
+            # 按 DCT 缩放解码（1/2、1/4、1/8），再缩到长边 RAW_PREVIEW_EDGE；Gemini 本身也会下采样
+            scale = RAW_PREVIEW_EDGE / max(im.size)
+            if scale < 1:
+                im.draft('RGB', (int(im.width * scale), int(im.height * scale)))
+            im.load()
+        except Exception:
+            continue
+        if im.mode != 'RGB': im = im.convert('RGB')
+        # DCT 缩放只有 2 的幂档位，落在上限 1.25 倍内就不再重采样（2064 -> 2048 要多花几十毫秒）
+        if max(im.size) > RAW_PREVIEW_EDGE * 1.25:
+            im.thumbnail((RAW_PREVIEW_EDGE, RAW_PREVIEW_EDGE))
+        try:
+            # EXIF 来自用户文件，类型异常（如 FLOAT 的 Model）时放弃 EXIF，仍返回预览
+            im.info['exif'] = _carry_exif(ifd0, exif_ifd).tobytes()
+            # 预览图按传感器方向存储，缩小后再按机身 Orientation 转正
+            ImageOps.exif_transpose(im, in_place=True)
+            return im
+        except Exception as e:
+            logger.warning(f"RAW exif carry failed: {e}")
+            im.info.pop('exif', None)
+            return im
+    return None
+
+def load_uploaded_image(f):
+    """上传入口：RAW 走内嵌预览，HEIC 走 pillow-heif，其它照旧交给 PIL。返回 (图片, 错误信息)。"""
+    ext = os.path.splitext(f.name)[1].lower().lstrip('.')
+    if ext in RAW_TYPES:
+        im = load_raw_image(f.getvalue())
+        if im is None:
+            return None, "⚠️ 该 RAW 文件未找到可用的内嵌预览图，请导出 JPG 后上传"
+        return im, None
+    if ext in HEIF_TYPES and not HEIF_SUPPORTED:
+        return None, "⚠️ 服务器未安装 HEIC 解码组件"
+    return Image.open(f).convert('RGB'), None
+
+# ================= 2.2 AI 调用：时限 / 取消 / 降级 =================
+class AnalysisError(Exception):
+    """评估失败（接口报错 / 内容被拦截等）；失败结果一律不进缓存。"""
+
+class AnalysisAborted(AnalysisError):
+    """评估超过时限。"""
+
+@st.cache_resource
+def get_ai_loop():
+    """全局后台事件循环：grpc.aio 请求跑在这里，才能真正 cancel 掉在途调用。"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_report_cache():
+    """已交付报告的进程级缓存 {key: (写入时间, 报告)}，只由 cached_ai 在成功后写入。"""
+    return {}
+
+async def _generate(img_b, prompt, model, timeout):
+    # 模型对象在循环线程内创建，异步 client 才会绑定到这个循环
+    im = Image.open(io.BytesIO(img_b))
+    cfg = genai.types.GenerationConfig(temperature=0.0)
+    m = genai.GenerativeModel(model, system_instruction=prompt)
+    # 关闭 SDK 默认重试（503 会退避重试到 600 秒）：失败立即抛出，由 run_analysis 决定兜底
+    resp = await m.generate_content_async([im, "分析"], generation_config=cfg, request_options={"timeout": timeout, "retry": None})
+    return resp.text
+
+def cached_ai(img_b, prompt, model, deadline, on_wait=None):
+    """先查报告缓存；未命中则在 deadline（time.monotonic()）前完成调用，成功才写缓存。
+
+    缓存不加锁：并发会话各自等待、各自受时限约束。on_wait 每 0.5 秒调用一次，
+    其中的 st 调用是 Streamlit 的打断点：用户清空重置 / 切换模式时运行在此中止，
+    finally 取消在途请求。超时抛 AnalysisAborted，其它失败抛 AnalysisError。
+    """
+    h = hashlib.md5(img_b)
+    h.update(f"{model}\n{prompt}".encode())
+    key = h.hexdigest()
+    cache = get_report_cache()
+    hit = cache.get(key)
+    if hit and time.time() - hit[0] < AI_CACHE_TTL:
+        return hit[1]
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0: raise AnalysisAborted(model)
+    fut = asyncio.run_coroutine_threadsafe(_generate(img_b, prompt, model, remaining), get_ai_loop())
+    try:
+        while not fut.done():
+            if time.monotonic() >= deadline: raise AnalysisAborted(model)
+            if on_wait: on_wait()
+            concurrent.futures.wait([fut], timeout=0.5)
+        text = fut.result()
+    except AnalysisError: raise
+    except Exception as e:
+        if time.monotonic() >= deadline: raise AnalysisAborted(model) from e
+        raise AnalysisError(f"{model}: {e}") from e
+    finally:
+        fut.cancel()
+
+    now = time.time()
+    for k, (t, _) in list(cache.items()):
+        if now - t >= AI_CACHE_TTL: cache.pop(k, None)
+    cache[key] = (now, text)
+    return text
+
+def run_analysis(img_b, prompt, check_mode, model, on_wait=None):
+    """按模式时限完成评估，返回 (报告, 是否降级)。
+
+    专业模型超时或报错时改用 DAILY_MODEL 兜底；兜底也失败则把 AnalysisError /
+    AnalysisAborted 交给调用方展示。
+    """
+    deadline = time.monotonic() + MODE_DEADLINES[check_mode]
+    if model != PRO_MODEL:
+        return cached_ai(img_b, prompt, model, deadline, on_wait), False
+    try:
+        return cached_ai(img_b, prompt, model, deadline - PRO_FALLBACK_RESERVE, on_wait), False
+    except AnalysisError as e:
+        logger.info(f"⭐⭐⭐ [MONITOR] FALLBACK | {PRO_MODEL} -> {DAILY_MODEL} | {type(e).__name__}: {e}")
+    return cached_ai(img_b, prompt, DAILY_MODEL, deadline, on_wait), True
+
 def create_html_report(text, user_req, img_base64):
     img_tag = f'<img src="data:image/jpeg;base64,{img_base64}" style="max-width:100%; border-radius:10px; margin-bottom:20px;">' if img_base64 else ""
     return f"""
@@ -258,8 +551,10 @@ def init_session_state():
         'font_size': 16,
         'dark_mode': False,
         'current_report': None,
+        'current_degraded': False,
         'last_img_hash': None,
         'uploader_key': 0,
+        'upload_cache': (None, None, None),
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -269,6 +564,7 @@ init_session_state()
 
 def clear_report_only():
     st.session_state.current_report = None
+    st.session_state.current_degraded = False
 
 def clear_camera():
     if 'cam_file' in st.session_state: del st.session_state['cam_file']
@@ -278,8 +574,10 @@ def clear_upload():
 
 def reset_all():
     st.session_state.current_report = None
+    st.session_state.current_degraded = False
     st.session_state.last_img_hash = None
     if 'current_image' in st.session_state: del st.session_state['current_image']
+    st.session_state.upload_cache = (None, None, None)
     st.session_state.uploader_key += 1 
 
 # ================= 4. 登录页 =================
@@ -504,7 +802,7 @@ def show_main_app():
     st.markdown(f"<style>.stMarkdown p, .stMarkdown li {{font-size: {font_size}px !important; line-height: 1.6;}}</style>", unsafe_allow_html=True)
 
     if "日常" in mode_select:
-        real_model = "gemini-2.0-flash-lite-preview-02-05"
+        real_model = DAILY_MODEL
         check_mode = 'daily'
         active_prompt = """你是一位亲切的摄影博主“智影”。
 请严格按照 Markdown 格式输出，标题与内容之间空一行。
@@ -528,7 +826,7 @@ def show_main_app():
         banner_text = "日常记录 | 适用：朋友圈、手机摄影、快速出片"
         banner_bg = "#e8f5e9" if not st.session_state.dark_mode else "#1b5e20"
     else:
-        real_model = "gemini-2.5-flash"
+        real_model = PRO_MODEL
         check_mode = 'pro'
         active_prompt = """你是一位视觉总监“智影”。
 请严格按照 Markdown 格式输出，标题与内容之间空一行。
@@ -578,12 +876,23 @@ def show_main_app():
     
     with tab1:
         f = st.file_uploader(
-            "支持 JPG/PNG", 
-            type=["jpg","png","webp"], 
+            "支持 JPG/PNG/RAW" + ("/HEIC" if HEIF_SUPPORTED else ""), 
+            type=["jpg","png","webp"] + RAW_TYPES + (HEIF_TYPES if HEIF_SUPPORTED else []), 
             key=f"up_file_{st.session_state.uploader_key}", 
             on_change=clear_camera
         )
-        if f: st.session_state.current_image = Image.open(f).convert('RGB')
+        if f:
+            # 同一上传只解析一次：RAW 预览解码不随每次交互 / rerun 重复
+            if st.session_state.upload_cache[0] != f.file_id:
+                st.session_state.upload_cache = (f.file_id, *load_uploaded_image(f))
+            _, im, err = st.session_state.upload_cache
+            if im:
+                st.session_state.current_image = im
+            else:
+                st.error(err)
+                if 'current_image' in st.session_state:
+                    del st.session_state['current_image']
+                    clear_report_only()
             
     with tab2:
         c = st.camera_input("点击拍摄", key="cam_file", on_change=clear_upload)
@@ -608,51 +917,62 @@ def show_main_app():
                 user_req = st.text_input("备注 (可选):", placeholder="例如：想修出日系感...")
                 
                 if st.button("🚀 开始评估", type="primary", use_container_width=True):
-                    # === 扣费逻辑 ===
-                    if st.session_state.user_role == 'guest':
-                        current_hash = get_image_hash(st.session_state.current_image)
-                        if st.session_state.last_img_hash != current_hash:
-                            allowed, msg = check_guest_permission(st.session_state.user_phone, check_mode)
-                            if not allowed:
-                                st.error(msg)
-                                st.info("请联系微信 **BayernGomez28** 开通会员。")
-                                st.stop()
-                            else:
-                                update_guest_usage(st.session_state.user_phone, check_mode)
-
-                    with st.status(status_msg, expanded=True) as s:
-                        logger.info(f"⭐⭐⭐ [MONITOR] ACTION | User: {st.session_state.user_phone} | Mode: {check_mode}")
-                        
-                        img_byte_arr = io.BytesIO()
-                        st.session_state.current_image.save(img_byte_arr, format='JPEG')
-                        img_bytes = img_byte_arr.getvalue()
-                        
-                        @st.cache_data(show_spinner=False, ttl=3600)
-                        def cached_ai(img_b, prompt, model):
+                    # 只编码一次：同一份 JPEG 既用于去重扣费，也直接发给模型
+                    img_byte_arr = io.BytesIO()
+                    st.session_state.current_image.save(img_byte_arr, format='JPEG')
+                    img_bytes = img_byte_arr.getvalue()
+                    current_hash = hashlib.md5(img_bytes).hexdigest()
+
+                    # === 扣费逻辑：先预扣，未交付（超时 / 报错 / 被打断）则在 finally 退回 ===
+                    charge_guest = st.session_state.user_role == 'guest' and st.session_state.last_img_hash != current_hash
+                    if charge_guest:
+                        allowed, msg = reserve_guest_usage(st.session_state.user_phone, check_mode)
+                        if not allowed:
+                            st.error(msg)
+                            st.info("请联系微信 **BayernGomez28** 开通会员。")
+                            st.stop()
+
+                    delivered = False
+                    try:
+                        with st.status(status_msg, expanded=True) as s:
+                            logger.info(f"⭐⭐⭐ [MONITOR] ACTION | User: {st.session_state.user_phone} | Mode: {check_mode}")
+                            
+                            started = time.monotonic()
+                            def on_wait():
+                                s.update(label=f"{status_msg} ({int(time.monotonic() - started)}s)")
+
                             try:
-                                im = Image.open(io.BytesIO(img_b))
-                                cfg = genai.types.GenerationConfig(temperature=0.0)
-                                m = genai.GenerativeModel(model, system_instruction=prompt)
-                                return m.generate_content([im, "分析"], generation_config=cfg).text
-                            except Exception as e: return f"ERROR: {e}"
-
-                        ai_result = cached_ai(img_bytes, active_prompt, real_model)
-                        
-                        if "ERROR:" in ai_result:
-                            st.error(ai_result)
-                        else:
-                            st.session_state.current_report = ai_result
-                            st.session_state.current_req = user_req
-                            st.session_state.last_img_hash = get_image_hash(st.session_state.current_image)
-                            s.update(label="✅ 分析完成", state="complete", expanded=False)
-                            st.rerun()
+                                ai_result, degraded = run_analysis(img_bytes, active_prompt, check_mode, real_model, on_wait)
+                            except AnalysisAborted:
+                                s.update(label="⏱️ 分析超时", state="error")
+                                st.error(f"⏱️ 分析超时（{MODE_DEADLINES[check_mode]} 秒），请稍后重试，本次不计次数")
+                            except AnalysisError as e:
+                                s.update(label="❌ 分析失败", state="error")
+                                st.error(f"ERROR: {e}")
+                            else:
+                                delivered = True
+                                if charge_guest and degraded and check_mode == 'pro':
+                                    downgrade_guest_usage(st.session_state.user_phone)
+                                st.session_state.current_report = ai_result
+                                st.session_state.current_degraded = degraded
+                                st.session_state.current_req = user_req
+                                st.session_state.last_img_hash = current_hash
+                                s.update(label="✅ 分析完成", state="complete", expanded=False)
+                                st.rerun()
+                    finally:
+                        # 也覆盖 Streamlit 的 RerunException / StopException（用户中途离开）
+                        if charge_guest and not delivered:
+                            update_guest_usage(st.session_state.user_phone, check_mode, -1)
             
             if st.session_state.current_report:
+                if st.session_state.current_degraded:
+                    st.warning("⚡ 专业模型超时或出错，本报告由快速模型生成（降级结果），可稍后重新评估")
                 st.markdown(f'<div class="result-card">{st.session_state.current_report}</div>', unsafe_allow_html=True)
                 
                 img_b64 = img_to_base64(st.session_state.current_image)
+                record_mode = mode_select + (" ⚡降级" if st.session_state.current_degraded else "")
                 if not st.session_state.history or st.session_state.history[-1]['content'] != st.session_state.current_report:
-                    record = {"time": datetime.now().strftime("%H:%M"), "mode": mode_select, "content": st.session_state.current_report, "img_base64": img_b64}
+                    record = {"time": datetime.now().strftime("%H:%M"), "mode": record_mode, "content": st.session_state.current_report, "img_base64": img_b64}
                     st.session_state.history.append(record)
                     if len(st.session_state.history) > 5: st.session_state.history.pop(0)
 
@@ -667,7 +987,7 @@ def show_main_app():
                 with btn_c2:
                     if st.session_state.user_role == 'vip':
                         if st.button("❤️ 加入收藏", use_container_width=True):
-                            record = {"time": datetime.now().strftime("%H:%M"), "mode": mode_select, "content": st.session_state.current_report, "img_base64": img_b64}
+                            record = {"time": datetime.now().strftime("%H:%M"), "mode": record_mode, "content": st.session_state.current_report, "img_base64": img_b64}
                             st.session_state.favorites.append(record)
                             st.toast("已收藏！", icon="⭐")
                     else: